@@ -1,15 +1,199 @@
+import contextvars
+import io
+import itertools
 import json
+import operator
+import threading
+import weakref
+from contextlib import contextmanager
 from enum import Enum
 from pathlib import Path
-import psycopg2
-
-conn = None
-
-def configure(db, user, password):
-    global conn
-    conn = psycopg2.connect(f"dbname={db} user={user} password={password}")
+from psycopg2.extras import execute_batch, execute_values
+from psycopg2.pool import ThreadedConnectionPool
+
+_pool = None
+# connection pinned by an active transaction() block
+_transaction_conn = contextvars.ContextVar("transaction_conn", default=None)
+# what the active transaction() did to instances, undone if it's rolled back
+_transaction_changes = contextvars.ContextVar("transaction_changes", default=None)
+# models whose tables haven't been checked against the database yet
+_pending_models = []
+# held while checking/changing the schema; .active is set in the thread doing it
+_schema_lock = threading.RLock()
+_schema_sync = threading.local()
+# instances saved with save(immediate=False) in this thread/context, written by flush()
+_pending_saves = contextvars.ContextVar("pending_saves", default=None)
+# table name -> state of the table as last created/migrated, see _schema_state()
+_schema_cache = None
+_SCHEMA_PATH = Path("db_state") / "_all.json"
+
+def configure(db, user, password, minconn=1, maxconn=16):
+    global _pool
+    if _pool is not None:  # reconfiguring: don't leak the old connections
+        _pool.closeall()
+    _pool = ThreadedConnectionPool(minconn, maxconn, f"dbname={db} user={user} password={password}")
+
+def sync_schema():
+    """Create or migrate the tables of all models defined so far.
+
+    This happens automatically before the first query, but can be called
+    explicitly to do it at a predictable time.
+    """
+    # other threads wait here until the tables exist
+    with _schema_lock:
+        if getattr(_schema_sync, "active", False):
+            return  # called again because the DDL below asks for a connection
+        _schema_sync.active = True
+        changed = False
+        try:
+            state = _schema_state()
+            # a model only leaves the list once it's synced, so a failing one
+            # (and those after it) is tried again next time
+            while _pending_models:
+                changed |= _pending_models[0]._sync_state(state)
+                del _pending_models[0]
+        finally:
+            _schema_sync.active = False
+            # the DDL of the models before a failing one went through either way
+            if changed:
+                _save_schema_state(state)
+
+def _schema_state():
+    # all tables' states live in a single file, read once
+    global _schema_cache
+    if _schema_cache is None:
+        if _SCHEMA_PATH.exists():
+            with _SCHEMA_PATH.open() as f:
+                _schema_cache = json.load(f)
+        else:
+            _schema_cache = {}
+    return _schema_cache
+
+def _save_schema_state(state):
+    _SCHEMA_PATH.parent.mkdir(exist_ok=True)
+    with _SCHEMA_PATH.open("w") as f:
+        json.dump(state, f)
+
+def _check_configured():
+    if _pool is None:
+        raise RuntimeError("Call cuneiform.configure() before running any queries")
+
+@contextmanager
+def _connection():
+    _check_configured()
+    if _pending_models:
+        sync_schema()
+    conn = _transaction_conn.get()
+    if conn is not None:
+        yield conn
+        return
+    conn = _pool.getconn()
+    # outside of transaction() every statement commits on its own
+    conn.autocommit = True
+    try:
+        yield conn
+    finally:
+        _pool.putconn(conn)
+
+@contextmanager
+def _cursor_connection():
+    # like _connection(), but for server-side cursors, which only live as
+    # long as the transaction they were declared in
+    _check_configured()
+    if _pending_models:
+        sync_schema()
+    conn = _transaction_conn.get()
+    if conn is not None:
+        yield conn
+        return
+    conn = _pool.getconn()
+    conn.autocommit = False
+    try:
+        yield conn
+    finally:
+        conn.rollback()  # only read, nothing to commit
+        _pool.putconn(conn)
+
+@contextmanager
+def transaction():
+    """Run everything inside the block on one connection, in one transaction."""
+    if _transaction_conn.get() is not None:  # nested: just become part of the outer transaction
+        yield
+        return
+    _check_configured()
+    if _pending_models:
+        sync_schema()
+    conn = _pool.getconn()
+    conn.autocommit = False
+    token = _transaction_conn.set(conn)
+    changes = []
+    changes_token = _transaction_changes.set(changes)
+    try:
+        yield
+        flush()
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        for instance, change, data in reversed(changes):
+            instance._undo(change, data)
+        raise
+    finally:
+        _transaction_changes.reset(changes_token)
+        _transaction_conn.reset(token)
+        _pool.putconn(conn)
+
+def _record_change(instance, change, data=None):
+    # see Model._undo
+    changes = _transaction_changes.get()
+    if changes is not None:
+        changes.append((instance, change, data))
+
+def flush():
+    """Write the instances this thread saved with save(immediate=False), with one statement per model."""
+    pending = _pending_saves.get()
+    if pending:
+        instances = pending.copy()
+        pending.clear()
+        Model.bulk_save(instances)
 
 missing = object()
+_nothing = frozenset()
+# kinds of Field values
+_KIND_INT, _KIND_STR, _KIND_MODEL, _KIND_ENUM = "int", "str", "model", "enum"
+_cursor_ids = itertools.count()
+# rows fetched at a time when iterating a recordset
+_FETCH_SIZE = 1000
+
+# generated SQL whose shape depends on more than the model (e.g. which columns
+# an UPDATE touches), keyed by (model, operation, columns)
+_sql_cache = {}
+
+# connection -> {name: EXECUTE statement} of the statements PREPAREd on it
+_prepared = weakref.WeakKeyDictionary()
+
+def _execute_prepared(conn, cur, name, sql, params):
+    # Prepared statements skip parsing and planning on every execution, but
+    # they live on one connection, and a PREPARE inside a transaction is gone
+    # after a rollback, so they're only used outside of transaction().
+    if not conn.autocommit:
+        cur.execute(sql, params)
+        return
+    prepared = _prepared.setdefault(conn, {})
+    execute = prepared.get(name)
+    if execute is None:
+        parts = sql.split("%s")
+        numbered = parts[0] + "".join(f"${i}{part}" for i, part in enumerate(parts[1:], 1))
+        cur.execute(f"PREPARE {name} AS {numbered}")
+        execute = prepared[name] = f"EXECUTE {name}({','.join(['%s'] * (len(parts) - 1))})"
+    cur.execute(execute, params)
+
+def _cached_sql(key, build):
+    sql = _sql_cache.get(key)
+    if sql is None:
+        sql = _sql_cache[key] = build()
+    return sql
+
+_enum_value = operator.attrgetter("value")
 
 def plural(name):
     # super simple pluralization
@@ -19,35 +203,117 @@ def plural(name):
         return f"{name[:-1]}ies"
     return f"{name}s"
 
+def _copy_text(value):
+    # encode a value for COPY's text format
+    if value is None:
+        return "\\N"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+class Reference:
+    """Placeholder for a foreign key whose target hasn't been loaded yet."""
+    __slots__ = ("model", "id")
+
+    def __init__(self, model, id):
+        self.model = model
+        self.id = id
+
+    def __repr__(self):
+        return f"<{self.model.__name__} id={self.id!r} (not loaded)>"
+
+
 class Model:
+    # _values: one entry per column (see Field._index), missing if not set.
+    # _deferred: columns that weren't selected when the instance was loaded.
+    # Subclasses can declare `__slots__ = ()` to get rid of the instance dict.
+    __slots__ = ("_values", "_dirty_mask", "_initializing", "_deferred", "__weakref__")
+
+    # identity map: (model class, id) -> instance, so repeated lookups of the
+    # same row don't go to the database again
+    _cache = weakref.WeakValueDictionary()
+
     def __init_subclass__(subclass):
-        assert conn, "Call cuneiform.configure() before defining any models"
         subclass._table_name = subclass.__name__.lower()  # FIXME CamelCase etc. ABCFoo
-        fields = {}
-        for field, value in vars(subclass).items():
-            if field == "id":
-                raise RuntimeError("Can't explicitly define an 'id' field")
-            if isinstance(value, Field):
-                fields[field] = value
-                if issubclass(value._type, Model):
-                    value._type.install_inverse(subclass, field, value)
+        if "id" in vars(subclass):
+            raise RuntimeError("Can't explicitly define an 'id' field")
+        fields = {field: value for field, value in vars(subclass).items() if isinstance(value, Field)}
+        for field, value in fields.items():
+            if value._kind is _KIND_MODEL:
+                value._type.install_inverse(subclass, field, value)
         fields["id"] = Field(int, required=True)
+        # set after class creation, so Python doesn't call __set_name__ for us
         fields["id"].__set_name__(subclass, "id")
         setattr(subclass, "id", fields["id"])
         subclass._fields = fields
-        subclass.ensure_db_state()
+        # table columns in order; virtual fields (which other models may still
+        # add to _fields later) are never columns, so these can be computed now
+        subclass._columns = tuple(k for k, v in fields.items() if not v._options.get("virtual"))
+        subclass._non_id_columns = tuple(k for k in subclass._columns if k != "id")
+        subclass._fk_columns = tuple(k for k in subclass._columns if fields[k]._kind is _KIND_MODEL)
+        subclass._required_columns = tuple(k for k in subclass._non_id_columns if fields[k]._options.get("required"))
+        subclass._insert_fields = tuple(
+            (k, fields[k], fields[k]._options.get("default", missing)) for k in subclass._non_id_columns
+        )
+        # each column gets a slot in the instances' _values
+        for i, column in enumerate(subclass._columns):
+            fields[column]._index = i
+        # from_sql() of each column, minus the method call (see _from_row)
+        subclass._converters = tuple(fields[column]._from_sql for column in subclass._columns)
+        # each column gets a bit in the instances' _dirty_mask
+        for i, column in enumerate(subclass._non_id_columns):
+            fields[column]._bit = 1 << i
+        subclass._state = {
+            "fields": {
+                name: {
+                    "type": fields[name]._sql_type,
+                    "options": fields[name]._options,
+                }
+                for name in subclass._columns
+            },
+            "foreign_keys": {
+                name: fields[name]._type._table_name
+                for name in subclass._fk_columns
+            },
+        }
+        # statements that only depend on the model's shape, built once
+        table, columns, non_id_columns = subclass._table_name, subclass._columns, subclass._non_id_columns
+        subclass._select_columns_sql = ",".join(f"{table}.{column}" for column in columns)
+        subclass._get_sql = f"SELECT {','.join(columns)} FROM {table} WHERE id=%s"
+        subclass._insert_sql = (
+            f"INSERT INTO {table} ({','.join(non_id_columns)}) "
+            f"VALUES ({','.join(['%s'] * len(non_id_columns))}) RETURNING {','.join(columns)}"
+        )
+        subclass._bulk_insert_sql = (
+            f"INSERT INTO {table} ({','.join(non_id_columns)}) VALUES %s RETURNING {','.join(columns)}"
+        )
+        # checking the database state is left until it's needed, so defining
+        # models stays cheap
+        _pending_models.append(subclass)
 
     def __init__(self, **kwargs):
         self._initializing = True
-        self._values = {}
-        self._dirty = False
+        self._values = [missing] * len(self._columns)
+        self._dirty_mask = 0
+        self._deferred = _nothing
         for k, v in kwargs.items():
-            assert k in self._fields, f"{k} is not in fields of {self}, only {self._fields}"
+            # not _fields: the virtual ones (inverse relations) can't be set
+            if k not in self._columns:
+                raise TypeError(f"{k} is not in fields of {type(self).__name__}, only {', '.join(self._columns)}")
             setattr(self, k, v)
-        for k, v in self._fields.items():
-            if v._options.get("required") and k != "id" and not v._options.get("virtual"):
-                assert k in kwargs, (k, kwargs, v._options.get("required"))
         self._initializing = False
+        self.validate()
+
+    def validate(self):
+        # only for instances created in Python; rows loaded from the database
+        # (see _from_row) are taken as they are
+        for k in self._required_columns:
+            if self._values[self._fields[k]._index] is missing:
+                raise ValueError(f"No value for required field {k} set")
 
     @classmethod
     def install_inverse(cls, other_model, field_name, field):
@@ -59,9 +325,9 @@ class Model:
 
     def __repr__(self):
         value_list = " ".join(
-            f"{k}={v!r}" for k, v in self._values.items()
+            f"{k}={v!r}" for k, v in zip(self._columns, self._values) if v is not missing
         )
-        return f"<{self.__class__.__name__}{'[D]' if self._dirty else ''} {value_list}>"
+        return f"<{self.__class__.__name__}{'[D]' if self._dirty_mask else ''} {value_list}>"
 
 
     @classmethod
@@ -71,66 +337,72 @@ class Model:
             {cls._table_name}
         CASCADE
         """
-        with conn.cursor() as cur:
+        with _connection() as conn, conn.cursor() as cur:
             cur.execute(sql)
-            conn.commit()
 
     @classmethod
     def ensure_db_state(cls):
+        with _schema_lock:
+            active = getattr(_schema_sync, "active", False)
+            _schema_sync.active = True
+            try:
+                state = _schema_state()
+                if cls._sync_state(state):
+                    _save_schema_state(state)
+            finally:
+                _schema_sync.active = active
+
+    @classmethod
+    def _sync_state(cls, state):
+        # bring the table up to date with the model; returns whether `state` changed
         new_state = cls.get_state()
-        state_path = (Path("db_state") / cls._table_name).with_suffix(".json")
-        if state_path.exists():
-            with state_path.open() as f:
-                old_state = json.load(f)
-            if old_state == new_state:
-                return  # nothing to do
+        old_state = state.get(cls._table_name)
+        if old_state is None:
+            # written by older versions, one file per table
+            legacy_path = (Path("db_state") / cls._table_name).with_suffix(".json")
+            if legacy_path.exists():
+                with legacy_path.open() as f:
+                    old_state = json.load(f)
+        if old_state == new_state:
+            if cls._table_name not in state:
+                state[cls._table_name] = new_state
+                return True
+            return False  # nothing to do
+        if old_state is not None:
             print(f"DB state: changes detected in {cls._table_name}, auto-migrating...")
             cls.migrate(old_state, new_state)
         else:
             print(f"DB state: table {cls._table_name} missing, creating...")
-            cls.drop()
-            cls.create()
-        state_path.parent.mkdir(exist_ok=True)
-        with state_path.open("w") as f:
-            json.dump(new_state, f)
+            cls.create(drop=True)
+        state[cls._table_name] = new_state
+        return True
 
 
     @classmethod
     def get_state(cls):
-        return {
-            "fields": {
-                name: {
-                    "type": field._sql_type,
-                    "options": field._options,
-                }
-                for name, field in cls._fields.items()
-                if not field._options.get("virtual")
-            },
-            "foreign_keys": {
-                name: field._type._table_name
-                for name, field in cls._fields.items()
-                if issubclass(field._type, Model) and not field._options.get("virtual")
-            },
-        }
+        # computed once in __init_subclass__, the columns can't change afterwards
+        return cls._state
 
     @classmethod
-    def create(cls):
+    def create(cls, drop=False):
         state = cls.get_state()
 
-        sql = f"""
+        # everything is sent as one script, i.e. in a single round trip
+        statements = []
+        if drop:
+            statements.append(f"DROP TABLE IF EXISTS {cls._table_name} CASCADE;")
+        statements.append(f"""
         CREATE TABLE IF NOT EXISTS
             {cls._table_name}
-        ({', '.join(name + " " + values["type"] for name, values in state["fields"].items())})
-        """
-        with conn.cursor() as cur:
-            cur.execute(sql)
-            for fk_name, fk_foreign in state["foreign_keys"].items():
-                sql = f"""
-                ALTER TABLE {cls._table_name} DROP CONSTRAINT IF EXISTS fk_{fk_name};
-                ALTER TABLE {cls._table_name} ADD CONSTRAINT fk_{fk_name} FOREIGN KEY ({fk_name}) REFERENCES {fk_foreign}(id);
-                """
-                cur.execute(sql)
-            conn.commit()
+        ({', '.join(name + " " + values["type"] for name, values in state["fields"].items())});
+        """)
+        for fk_name, fk_foreign in state["foreign_keys"].items():
+            statements.append(f"""
+            ALTER TABLE {cls._table_name} DROP CONSTRAINT IF EXISTS fk_{fk_name};
+            ALTER TABLE {cls._table_name} ADD CONSTRAINT fk_{fk_name} FOREIGN KEY ({fk_name}) REFERENCES {fk_foreign}(id);
+            """)
+        with _connection() as conn, conn.cursor() as cur:
+            cur.execute("\n".join(statements))
         print(f"DB state: created table {cls._table_name}")
 
     @classmethod
@@ -138,7 +410,8 @@ class Model:
         instructions = []
         # TODO: detect renamed fields, etc.
         table = cls._table_name
-        for field in {*old_state["fields"], *new_state["fields"]}:
+        # not a set: new columns should be added in the order they're declared in
+        for field in {**old_state["fields"], **new_state["fields"]}:
             if field not in new_state["fields"]:
                 print(f" -> dropping old field {field}")
                 instructions.append(f"ALTER TABLE {table} DROP COLUMN {field};")
@@ -152,93 +425,315 @@ class Model:
                         ALTER TABLE {table} ADD CONSTRAINT fk_{field} FOREIGN KEY ({field}) REFERENCES {new_state['foreign_keys'][field]}(id);
                         """
                     )
-        with conn.cursor() as cur:
+        with _connection() as conn, conn.cursor() as cur:
             cur.execute("\n".join(instructions))
-            conn.commit()
 
 
     @classmethod
-    def get(cls, id):
+    def _projection(cls, field_names):
+        # the columns to load for the given fields, in table order (always including id)
+        for name in field_names:
+            if name not in cls._columns:
+                raise ValueError(f"{name} is not a column of {cls.__name__}")
+        return tuple(column for column in cls._columns if column == "id" or column in field_names)
+
+    @classmethod
+    def _from_row(cls, columns, row):
+        instance = cls.__new__(cls)
+        instance._initializing = False
+        instance._dirty_mask = 0
+        fields = cls._fields
+        if len(columns) == len(cls._columns):
+            instance._values = [
+                value if value is None or convert is None else convert(value)
+                for convert, value in zip(cls._converters, row)
+            ]
+            instance._deferred = _nothing
+        else:
+            # only some columns were selected, the others are loaded when first accessed
+            instance._values = values = [missing] * len(cls._columns)
+            for column, value in zip(columns, row):
+                field = fields[column]
+                values[field._index] = field.from_sql(value)
+            instance._deferred = frozenset(cls._columns).difference(columns)
+        return instance
+
+    def _load_deferred(self):
+        cls = type(self)
+        columns = tuple(column for column in cls._columns if column in self._deferred)
+        sql = _cached_sql((cls, "get", columns), lambda: f"SELECT {','.join(columns)} FROM {cls._table_name} WHERE id=%s")
+        with _connection() as conn, conn.cursor() as cur:
+            cur.execute(sql, (self.id,))
+            row = cur.fetchone()
+        for column, value in zip(columns, row):
+            field = cls._fields[column]
+            self._values[field._index] = field.from_sql(value)
+        self._deferred = _nothing
+
+    @classmethod
+    def get(cls, id, fields=None):
         # return instance from database or cache
-        columns = {column: value for column, value in cls._fields.items() if not value._options.get("virtual")}
-        sql = f"""
-        SELECT {",".join(columns)}
-        FROM {cls._table_name}
-        WHERE id=%s
-        """
-        with conn.cursor() as cur:
-            cur.execute(sql, (id,))
-            values = cur.fetchone()
-        instance = cls(**{column: columns[column].from_sql(value) for column, value in zip(columns, values)})
-        instance._dirty = False
+        instance = Model._cache.get((cls, id))
+        if instance is not None:
+            return instance
+        if fields is None:
+            columns = cls._columns
+            with _connection() as conn, conn.cursor() as cur:
+                _execute_prepared(conn, cur, f"cuneiform_get_{cls._table_name}", cls._get_sql, (id,))
+                values = cur.fetchone()
+        else:
+            columns = cls._projection(fields)
+            sql = _cached_sql((cls, "get", columns), lambda: f"SELECT {','.join(columns)} FROM {cls._table_name} WHERE id=%s")
+            with _connection() as conn, conn.cursor() as cur:
+                cur.execute(sql, (id,))
+                values = cur.fetchone()
+        instance = cls._from_row(columns, values)
+        Model._cache[cls, id] = instance
         return instance
 
-    def save(self):
-        if not self._dirty:
+    @classmethod
+    def get_many(cls, ids):
+        """Load the instances with the given ids in one query, as {id: instance}."""
+        instances = {}
+        missing_ids = []
+        for id in ids:
+            instance = Model._cache.get((cls, id))
+            if instance is None:
+                missing_ids.append(id)
+            else:
+                instances[id] = instance
+        if missing_ids:
+            sql = _cached_sql((cls, "get_many"), lambda: f"SELECT {','.join(cls._columns)} FROM {cls._table_name} WHERE id = ANY(%s)")
+            with _connection() as conn, conn.cursor() as cur:
+                cur.execute(sql, (missing_ids,))
+                rows = cur.fetchall()
+            for row in rows:
+                instance = cls._from_row(cls._columns, row)
+                instances[instance.id] = Model._cache.setdefault((cls, instance.id), instance)
+        return instances
+
+    def _update_row(self):
+        # only the columns that changed
+        columns, values = [], []
+        fields, current, non_id_columns = self._fields, self._values, self._non_id_columns
+        mask = self._dirty_mask
+        while mask:
+            bit = mask & -mask  # lowest set bit
+            mask ^= bit
+            k = non_id_columns[bit.bit_length() - 1]
+            columns.append(k)
+            field = fields[k]
+            values.append(field.to_sql(current[field._index]))
+        return columns, values
+
+    def _insert_row(self):
+        values = []
+        current = self._values
+        for k, v, default in self._insert_fields:
+            value = current[v._index]
+            if value is missing:
+                if default is missing:
+                    raise ValueError(f"No value for {k} set and no default present")
+                value = default
+            values.append(v.to_sql(value))
+        return self._non_id_columns, values
+
+    def _refresh(self, row):
+        # take over what the database actually stored (the id, but also
+        # anything filled in by the server), skipping Field.__set__
+        fields = self._fields
+        self._values = [fields[column].from_sql(value) for column, value in zip(self._columns, row)]
+
+    def _take_over(self, values):
+        # the database was updated with these values behind our back
+        for key, value in values.items():
+            field = self._fields[key]
+            self._values[field._index] = value
+            self._dirty_mask &= ~field._bit
+        self._deferred = self._deferred.difference(values)
+        _record_change(self, "take_over", tuple(values))
+
+    def _undo(self, change, data):
+        # the transaction that wrote this instance was rolled back
+        cls = type(self)
+        if change == "insert":
+            # the row doesn't exist after all: forget the id, and save everything again
+            Model._cache.pop((cls, self.id), None)
+            self._values[cls._fields["id"]._index] = missing
+            self._dirty_mask = (1 << len(cls._non_id_columns)) - 1
+        elif change == "update":
+            self._dirty_mask |= data  # the columns written
+        elif change == "take_over":
+            # the values are the rolled back ones: load them again when accessed
+            for key in data:
+                self._values[cls._fields[key]._index] = missing
+            self._deferred = self._deferred.union(data)
+
+    def save(self, immediate=True):
+        if not self._dirty_mask:
+            return
+        if not immediate:
+            # written together with the others by flush() (or at the end of transaction())
+            pending = _pending_saves.get()
+            if pending is None:
+                pending = []
+                _pending_saves.set(pending)
+            pending.append(self)
             return
         if self.id:
-            assignments = [
-                f"{key}=%s"
-                for key in self._fields
-                if key != "id" and self._values.get(key, missing) is not missing
-                and not self._fields[key]._options("virtual")
-            ]
-            sql = f"""
+            columns, values = self._update_row()
+            sql = _cached_sql((type(self), "update", tuple(columns)), lambda: f"""
             UPDATE {self._table_name}
-            SET {",".join(assignments)}
+            SET {",".join(f"{column}=%s" for column in columns)}
             WHERE id = %s;
-            """
-            with conn.cursor() as cur:
-                cur.execute(sql, [
-                    *(
-                        v.to_sql(self._values[k])
-                        for (k, v) in self._fields.items()
-                        if k != "id" and self._values.get(k, missing) is not missing
-                        and not v._options.get("virtual")
-                    ),
-                    self.id,
-                ])
-                conn.commit()
+            """)
+            with _connection() as conn, conn.cursor() as cur:
+                cur.execute(sql, [*values, self.id])
+            _record_change(self, "update", self._dirty_mask)
         else:
-            columns, values = [], []
-            for k, v in self._fields.items():
-                if k == "id" or v._options.get("virtual"):
-                    continue
-                columns.append(k)
-                default = v._options.get("default", missing)
-                value = self._values.get(k, missing)
-                if value is not missing:
-                    values.append(v.to_sql(value))
-                elif default is not missing:
-                    values.append(v.to_sql(default))
+            _, values = self._insert_row()
+            with _connection() as conn, conn.cursor() as cur:
+                _execute_prepared(conn, cur, f"cuneiform_insert_{self._table_name}", self._insert_sql, values)
+                self._refresh(cur.fetchone())
+            _record_change(self, "insert")
+        Model._cache[type(self), self.id] = self
+        self._dirty_mask = 0
+
+    @staticmethod
+    def bulk_save(instances):
+        """Save many instances with one statement per model instead of one per instance."""
+        # each instance only once, and only if there's something to save
+        instances = [instance for instance in dict.fromkeys(instances) if instance._dirty_mask]
+        with transaction():
+            # referenced instances that need saving are saved in bulk first,
+            # instead of one by one from Field.to_sql
+            referenced = [
+                value
+                for instance in instances
+                for value in instance._values
+                if isinstance(value, Model) and value._dirty_mask
+            ]
+            if referenced:
+                Model.bulk_save(referenced)
+                # some of them may have been in `instances`, too
+                instances = [instance for instance in instances if instance._dirty_mask]
+            inserts, updates = {}, {}
+            for instance in instances:
+                if instance.id:
+                    columns, values = instance._update_row()
+                    if not columns:  # nothing changed after all
+                        continue
+                    key = (type(instance), tuple(columns))
+                    updates.setdefault(key, []).append((instance, (*values, instance.id)))
                 else:
-                    raise ValueError(f"No value for {k} set and no default present")
-            sql = f"""
-            INSERT INTO
-                {self._table_name}
-                ({",".join(columns)})
-            VALUES
-                ({",".join(["%s"]*len(values))})
-            RETURNING
-                id;
-            """
-            with conn.cursor() as cur:
-                cur.execute(sql, values)
-                self._values["id"] = cur.fetchone()[0]  # skip Field.__set__
-                conn.commit()
-        self._dirty = False
+                    columns, values = instance._insert_row()
+                    key = (type(instance), tuple(columns))
+                    inserts.setdefault(key, []).append((instance, tuple(values)))
+            with _connection() as conn, conn.cursor() as cur:
+                for (cls, columns), group in inserts.items():
+                    rows = execute_values(cur, cls._bulk_insert_sql, [row for _, row in group], page_size=1000, fetch=True)
+                    for (instance, _), row in zip(group, rows):
+                        instance._refresh(row)
+                        _record_change(instance, "insert")
+                for (cls, columns), group in updates.items():
+                    sql = _cached_sql((cls, "update", columns), lambda: f"""
+                    UPDATE {cls._table_name}
+                    SET {",".join(f"{column}=%s" for column in columns)}
+                    WHERE id = %s;
+                    """)
+                    execute_batch(cur, sql, [row for _, row in group], page_size=500)
+                    for instance, _ in group:
+                        _record_change(instance, "update", instance._dirty_mask)
+        for group in (*inserts.values(), *updates.values()):
+            for instance, _ in group:
+                Model._cache[type(instance), instance.id] = instance
+                instance._dirty_mask = 0
+
+    @classmethod
+    def copy_from(cls, rows, batch_size=10000):
+        """Insert many rows (dicts of field values) via COPY, without creating instances."""
+        columns = {k: cls._fields[k] for k in cls._non_id_columns}
+        sql = f"COPY {cls._table_name} ({','.join(columns)}) FROM STDIN"
+        rows = iter(rows)
+        with transaction(), _connection() as conn, conn.cursor() as cur:
+            while batch := list(itertools.islice(rows, batch_size)):
+                buffer = io.StringIO()
+                for row in batch:
+                    values = []
+                    for k, v in columns.items():
+                        value = row.get(k, v._options.get("default", missing))
+                        if value is missing:
+                            raise ValueError(f"No value for {k} set and no default present")
+                        values.append(_copy_text(v.to_sql(value)))
+                    buffer.write("\t".join(values))
+                    buffer.write("\n")
+                buffer.seek(0)
+                cur.copy_expert(sql, buffer)
 
     @classmethod
     def select(cls, **kwargs):
         return RecordSet(cls, **kwargs)
 
+    @classmethod
+    def bulk_delete(cls, ids):
+        """Delete the rows with the given ids in one statement."""
+        cls.select().delete_many(ids)
+
+    @classmethod
+    def bulk_update(cls, rows):
+        """Update many rows in one transaction; rows are (id, {field: value}) pairs."""
+        cls.select().update_many(rows)
+
 
 class RecordSet:
-    def __init__(self, model_class, where=None, limit=None, order_by=None):
+    __slots__ = ("model_class", "where", "limit", "order_by", "prefetch_fields", "only_fields", "hints", "_order_by_sql", "_length")
+
+    def __init__(
+        self, model_class, where=None, limit=None, order_by=None, prefetch_fields=(), only_fields=None, hints=None
+    ):
         self.model_class = model_class
         self.where = where
         self.limit = limit
         self.order_by = order_by
+        self.prefetch_fields = prefetch_fields
+        self.only_fields = only_fields
+        if hints and "*/" in hints:  # would end the comment they're put in
+            raise ValueError(f"Invalid hints {hints!r}")
+        self.hints = hints
+        self._length = None  # known after iterating over all of it, see __len__
+        if order_by:
+            # a string (e.g. Company.name.asc, i.e. "name ASC"), a field, or a list/tuple of them
+            if not isinstance(order_by, (list, tuple)):
+                order_by = (order_by,)
+            order_by = tuple(term._name if isinstance(term, Field) else term for term in order_by)
+            self._order_by_sql = _cached_sql((model_class, "order_by", order_by), lambda: self._build_order_by(order_by))
+        else:
+            self._order_by_sql = ""
+
+    def _build_order_by(self, order_by):
+        # the terms end up in the SQL as they are, so only known columns and directions are allowed
+        table = self.model_class._table_name
+        terms = []
+        for term in order_by:
+            if not isinstance(term, str):
+                raise TypeError(f"Can't order {self.model_class.__name__} by {term!r}")
+            column, _, direction = term.partition(" ")
+            if column not in self.model_class._columns or direction.upper() not in ("", "ASC", "DESC"):
+                raise ValueError(f"Can't order {self.model_class.__name__} by {term!r}")
+            terms.append(f"{table}.{column} {direction}".rstrip())
+        return f"ORDER BY {', '.join(terms)}"
+
+    def _replace(self, **changes):
+        kwargs = {
+            "where": self.where,
+            "limit": self.limit,
+            "order_by": self.order_by,
+            "prefetch_fields": self.prefetch_fields,
+            "only_fields": self.only_fields,
+            "hints": self.hints,
+            **changes,
+        }
+        return type(self)(self.model_class, **kwargs)
 
     def __repr__(self):
         return f"<RecordSet({self.model_class.__name__}) {self.where if self.where else ''}>"
@@ -246,6 +741,9 @@ class RecordSet:
     def _resolve_where(self):
         if self.where:
             where_sql, literals, joins = self.where.to_sql()
+            # each path only needs to be joined once, even if several
+            # conditions go through it (e.g. Order.customer.name and .age)
+            joins = dict.fromkeys(joins)
             join_expression = "\n".join(
                 "JOIN {foreign} ON {foreign}.{foreign_column} = {source}.{source_column}".format(
                     foreign=foreign,
@@ -258,63 +756,175 @@ class RecordSet:
         else:
             return "", "", []
 
-    def __iter__(self):
+    def _select_sql(self):
+        # (selected columns, SELECT statement, literals) for iterating
         where_expression, join_expression, literals = self._resolve_where()
 
-        limit_expression = f"LIMIT {int(self.limit)}" if self.limit else ""
-        if isinstance(self.order_by, tuple):
-            order_by = f"{', '.join(self.order_by)}"
-        order_by_expression = f"ORDER BY {self.order_by}" if self.order_by else ""
+        if self.limit:
+            # a parameter, so the statement is the same for every limit
+            limit_expression = "LIMIT %s"
+            literals = [*literals, int(self.limit)]
+        else:
+            limit_expression = ""
 
+        cls = self.model_class
+        if self.only_fields is None:
+            columns, select_columns_sql = cls._columns, cls._select_columns_sql
+        else:
+            # prefetched foreign keys need their column, too
+            columns = cls._projection((*self.only_fields, *self.prefetch_fields))
+            select_columns_sql = ",".join(f"{cls._table_name}.{column}" for column in columns)
+        # fetch full rows in one go instead of SELECTing ids and calling .get() per row
         sql = f"""
+        {f"/*+ {self.hints} */" if self.hints else ""}
         SELECT
-            {self.model_class._table_name}.id
+            {select_columns_sql}
         FROM
-            {self.model_class._table_name}
+            {cls._table_name}
         {join_expression}
         {where_expression}
-        {order_by_expression}
+        {self._order_by_sql}
         {limit_expression}
         """
-        with conn.cursor() as cur:
+        return columns, sql, literals
+
+    def __iter__(self):
+        columns, sql, literals = self._select_sql()
+        if self.limit and self.limit <= _FETCH_SIZE:
+            # a few rows: one plain query is cheaper than a server-side cursor
+            # (which needs BEGIN, DECLARE, FETCH, CLOSE and ROLLBACK)
+            with _connection() as conn, conn.cursor() as cur:
+                cur.execute(sql, literals)
+                rows = cur.fetchall()
+            yield from self._hydrate(columns, rows)
+            self._length = len(rows)
+            return
+        # stream the result through a server-side cursor instead of loading it
+        # all at once (saves in the loop body use other connections, unless
+        # we're in a transaction(), where everything is committed together)
+        with _cursor_connection() as conn, conn.cursor(name=f"recordset_{next(_cursor_ids)}") as cur:
             cur.execute(sql, literals)
-            for row in cur.fetchall():
-                yield self.model_class.get(row[0])
+            length = 0
+            while True:
+                rows = cur.fetchmany(_FETCH_SIZE)
+                length += len(rows)
+                yield from self._hydrate(columns, rows)
+                if len(rows) < _FETCH_SIZE:  # that was the last batch, don't ask again
+                    break
+        self._length = length
+
+    def _hydrate(self, columns, rows):
+        cls = self.model_class
+        # load the targets of prefetched foreign keys with one query per field;
+        # keeping them referenced here keeps them in the identity map
+        queries = []
+        for name in self.prefetch_fields:
+            fk_type = cls._fields[name]._type
+            index = columns.index(name)
+            ids = {row[index] for row in rows if row[index] is not None}
+            ids = [id for id in ids if (fk_type, id) not in Model._cache]
+            if ids:
+                queries.append((fk_type, ids))
+        # one after the other: running them in parallel would need another pooled
+        # connection each while this iteration holds one already, and the pool
+        # raises instead of waiting when it's exhausted
+        prefetched = [fk_type.get_many(ids) for fk_type, ids in queries]
+        id_index = columns.index("id")
+        cache, from_row = Model._cache, cls._from_row
+        prefetch_indexes = [cls._fields[name]._index for name in self.prefetch_fields]
+        for row in rows:
+            instance = cache.get((cls, row[id_index]))
+            if instance is None:
+                instance = from_row(columns, row)
+                cache[cls, row[id_index]] = instance
+            values = instance._values
+            for index in prefetch_indexes:
+                value = values[index]
+                if isinstance(value, Reference):
+                    values[index] = cache.get((value.model, value.id), value)
+            yield instance
 
     def filter(self, where_expr):
-        assert isinstance(where_expr, Expression)
+        if not isinstance(where_expr, Expression):
+            raise TypeError(f"Can't filter by {where_expr!r}, expected an expression")
         if not self.where:
             new_where = where_expr
         else:
-            new_where = Expression("AND", [self.where, where_expr])
-        return type(self)(
-            self.model_class,
-            limit=self.limit,
-            order_by=self.order_by,
-            where=new_where,
-        )
+            new_where = self.where & where_expr
+        return self._replace(where=new_where)
+
+    def prefetch(self, *field_names):
+        """Load the targets of the given foreign keys in one query per field."""
+        for name in field_names:
+            if name not in self.model_class._fk_columns:
+                raise ValueError(f"{name} is not a foreign key of {self.model_class.__name__}")
+        return self._replace(prefetch_fields=(*self.prefetch_fields, *field_names))
+
+    def only(self, *field_names):
+        """Only load the given fields; the others are fetched when first accessed."""
+        self.model_class._projection(field_names)  # validate
+        return self._replace(only_fields=field_names)
+
+    def hint(self, hints):
+        """Add planner hints (for the pg_hint_plan extension), e.g. "IndexScan(company)"."""
+        return self._replace(hints=hints)
+
+    def explain(self, analyze=False):
+        """Return PostgreSQL's plan for iterating this recordset (running it if analyze is set)."""
+        _, sql, literals = self._select_sql()
+        options = "ANALYZE, BUFFERS, FORMAT JSON" if analyze else "FORMAT JSON"
+        with _connection() as conn, conn.cursor() as cur:
+            cur.execute(f"EXPLAIN ({options}) {sql}", literals)
+            return cur.fetchone()[0]
 
-    def delete(self):
+    def _target_condition(self):
+        # WHERE condition (without "WHERE") for UPDATE/DELETE, which can't JOIN
+        # directly: conditions that need joins become an id subquery
         where_expression, join_expression, literals = self._resolve_where()
+        if not join_expression:
+            return where_expression[len("WHERE "):], literals
+        table = self.model_class._table_name
+        return f"""{table}.id IN (
+            SELECT {table}.id
+            FROM {table}
+            {join_expression}
+            {where_expression}
+        )""", literals
+
+    def delete(self):
+        self._length = None  # see __len__
+        condition, literals = self._target_condition()
         sql = f"""
         DELETE
         FROM
             {self.model_class._table_name}
-        {join_expression}
-        {where_expression}
+        {"WHERE " + condition if condition else ""}
+        RETURNING
+            {self.model_class._table_name}.id
         """
-        with conn.cursor() as cur:
+        with _connection() as conn, conn.cursor() as cur:
             cur.execute(sql, literals)
-            conn.commit()
+            ids = [id for id, in cur.fetchall()]
+        for id in ids:
+            Model._cache.pop((self.model_class, id), None)
+
+    def delete_many(self, ids):
+        """Delete the rows with the given ids (if they're part of this recordset) in one statement."""
+        self._length = None  # see __len__
+        ids = list(ids)
+        if ids:  # "IN ()" isn't valid SQL
+            self.filter(self.model_class.id.in_(ids)).delete()
 
     def update(self, **kwargs):
         # convert via self.model_class._fields -> to_sql
-        where_expression, join_expression, literals = self._resolve_where()
+        self._length = None  # rows may not match the filter anymore, see __len__
+        condition, literals = self._target_condition()
 
-        assert "id" not in kwargs
+        if "id" in kwargs:
+            raise ValueError("Can't update the id")
 
         assignments = [
-            f"{self.model_class._table_name}.{key}=%s"
+            f"{key}=%s"  # PostgreSQL doesn't allow qualifying the column with the table here
             for key in kwargs
         ]
 
@@ -322,11 +932,12 @@ class RecordSet:
         UPDATE
             {self.model_class._table_name}
         SET {",".join(assignments)}
-        {join_expression}
-        {where_expression}
+        {"WHERE " + condition if condition else ""}
+        RETURNING
+            {self.model_class._table_name}.id
         """
 
-        with conn.cursor() as cur:
+        with _connection() as conn, conn.cursor() as cur:
             cur.execute(
                 sql,
                 [
@@ -336,9 +947,68 @@ class RecordSet:
                     *literals,
                 ],
             )
-            conn.commit()
+            ids = [id for id, in cur.fetchall()]
+        # bring the instances we have in memory up to date, instead of
+        # evicting them (and losing their identity)
+        for id in ids:
+            instance = Model._cache.get((self.model_class, id))
+            if instance is not None:
+                instance._take_over(kwargs)
+
+    def update_many(self, rows):
+        """Give many rows different values at once; rows are (id, {field: value}) pairs.
+
+        Rows that don't match this recordset's filter are left alone.
+        """
+        self._length = None  # see __len__
+        cls = self.model_class
+        table = cls._table_name
+        groups = {}  # rows with the same fields can share one statement
+        for id, values in rows:
+            if "id" in values:
+                raise ValueError("Can't update the id")
+            groups.setdefault(tuple(values), []).append((id, values))
+        condition, literals = self._target_condition()
+        with transaction(), _connection() as conn, conn.cursor() as cur:
+            if condition:
+                # execute_values only fills in the VALUES list, so the filter's
+                # literals have to be in the statement already
+                condition = "AND " + cur.mogrify(condition, literals).decode().replace("%", "%%")
+            for columns, group in groups.items():
+                fields = [cls._fields[column] for column in columns]
+                sql = f"""
+                UPDATE
+                    {table}
+                SET {",".join(f"{column}=v.{column}" for column in columns)}
+                FROM
+                    (VALUES %s) AS v(id, {",".join(columns)})
+                WHERE
+                    {table}.id = v.id
+                    {condition}
+                RETURNING
+                    {table}.id
+                """
+                # without the casts, a column with only NULLs would be text
+                template = f"(%s::int, {','.join(f'%s::{field._sql_type}' for field in fields)})"
+                updated = execute_values(
+                    cur,
+                    sql,
+                    [(id, *(field.to_sql(values[field._name]) for field in fields)) for id, values in group],
+                    template=template,
+                    page_size=1000,
+                    fetch=True,
+                )
+                updated = {id for id, in updated}
+                for id, values in group:
+                    instance = Model._cache.get((cls, id))
+                    if id in updated and instance is not None:
+                        instance._take_over(values)
 
     def __len__(self):
+        # A snapshot as of the last complete iteration, if there was one: rows
+        # changed through this recordset reset it, others (e.g. new rows) don't.
+        if self._length is not None:
+            return self._length
         where_expression, join_expression, literals = self._resolve_where()
         sql = f"""
         SELECT
@@ -349,14 +1019,35 @@ class RecordSet:
         {where_expression}
         """
 
-        with conn.cursor() as cur:
+        with _connection() as conn, conn.cursor() as cur:
             cur.execute(sql, literals)
-            return cur.fetchone()[0]
+            count = cur.fetchone()[0]
+        return min(count, self.limit) if self.limit else count
+
+    def exists(self):
+        """Whether there is at least one matching row (cheaper than len())."""
+        where_expression, join_expression, literals = self._resolve_where()
+        sql = f"""
+        SELECT
+            1
+        FROM
+            {self.model_class._table_name}
+        {join_expression}
+        {where_expression}
+        LIMIT 1
+        """
+        with _connection() as conn, conn.cursor() as cur:
+            cur.execute(sql, literals)
+            return cur.fetchone() is not None
+
+    def count_estimate(self):
+        """The planner's estimate of the number of rows, without counting them."""
+        return self.explain()[0]["Plan"]["Plan Rows"]
 
     def get(self):
-        # Assert length and get a single one
+        # Assert length and get a single one; two rows are enough to tell
         result = None
-        for instance in self:
+        for instance in self._replace(limit=min(self.limit or 2, 2)):
             if result is None:
                 result = instance
                 continue
@@ -365,41 +1056,48 @@ class RecordSet:
 
 
 class Field:
+    __slots__ = (
+        "_type", "_name", "_options", "_index", "_bit", "_joins", "_owner", "_kind", "_sql_type",
+        "_from_sql", "_to_sql", "desc", "asc",
+    )
+
     def __init__(self, type, **options):
         self._type = type
         self._name = None
         self._options = options
+        self._index = None  # see Model._values; stays None for virtual fields
+        self._bit = 0  # see Model._dirty_mask
+        self._joins = {}  # see __getattr__
+        self._kind = None  # see __set_name__
 
     def __repr__(self):
         return self._name
 
     def from_sql(self, sql):
-        if sql is None:
-            return None
-        if self._type in [str, int]:
+        # _from_sql is None when there's nothing to convert, see __set_name__
+        if sql is None or self._from_sql is None:
             return sql
-        elif issubclass(self._type, Model):
-            return self._type.get(sql)
-        elif issubclass(self._type, Enum):
-            return self._type(sql)
-        raise TypeError(f"Don't know how to transform value of type {type(value)} from SQL")
+        return self._from_sql(sql)
 
     def to_sql(self, value=missing):
         if value is missing:  # when evaluated as part of a WHERE clause
             return f"{self._owner._table_name}.{self._name}"
-        if value is None:
-            return None  # NULL
-        if self._type is str:
+        if value is None or self._to_sql is None:
             return value
-        if issubclass(self._type, Enum):
-            return value.value
-        if issubclass(self._type, Model):
-            assert isinstance(value, self._type)
-            value.save()
+        return self._to_sql(value)
+
+    def _reference(self, sql):
+        # don't load the target until it is accessed
+        return Model._cache.get((self._type, sql)) or Reference(self._type, sql)
+
+    def _model_id(self, value):
+        if isinstance(value, Reference):
             return value.id
-        if self._type is int:
-            return value
-        raise TypeError(f"Don't know how to transform value of type {type(value)} to SQL")
+        if not isinstance(value, self._type):
+            raise TypeError(f"Expected {self._type.__name__} for {self._name}, got {type(value).__name__}")
+        if value._dirty_mask:  # skip the call for the common, clean case
+            value.save()
+        return value.id
 
 
     def __get__(self, instance, owner=None):
@@ -409,27 +1107,49 @@ class Field:
         # get value from DB or cached (?)
         if instance is None:
             return self
-        if self._options.get("virtual"):
+        index = self._index
+        if index is None:  # virtual
             # example: some_addr.customers -> Customer.select(where=Customer.addr=some_addr)
             return self._type.select(
                 where=getattr(self._type, self._options["forward_name"]) == instance,
             )
-        return instance._values.get(self._name)
+        value = instance._values[index]
+        if value is missing:
+            if self._name not in instance._deferred:
+                return None  # not set yet
+            instance._load_deferred()
+            value = instance._values[index]
+        if isinstance(value, Reference):
+            value = instance._values[index] = value.model.get(value.id)
+        return value
 
     def __set__(self, instance, value):
         # set value to DB or write-cache
         # TODO: casting / typechecking
-        if value == instance._values.get(self._name):
+        index = self._index
+        if index is None:
+            raise AttributeError(f"Can't set {self._name}, it's the other side of {self._type.__name__}.{self._options['forward_name']}")
+        current = instance._values[index]
+        if current is value:
             return
-        assert isinstance(value, self._type)
-        instance._values[self._name] = value
-        if instance.id:
-            if instance._initializing:
-                pass
-            else:
-                instance._dirty = True
-        else:
-            instance._dirty = True
+        if value is not None and not isinstance(value, self._type):  # None is NULL
+            # foreign keys also take References (to the right model)
+            if not (self._kind is _KIND_MODEL and isinstance(value, Reference) and value.model is self._type):
+                raise TypeError(f"Expected {self._type.__name__} for {self._name}, got {value!r}")
+        if self._kind is _KIND_MODEL:
+            # Models/References compare by identity, so look at the ids: a
+            # loaded instance for the row that's referenced already (e.g.
+            # instead of its Reference) is no change
+            if current not in (missing, None) and value is not None and value.id and current.id == value.id:
+                instance._values[index] = value
+                return
+        elif current == value:
+            return
+        instance._values[index] = value
+        if self._name in instance._deferred:
+            instance._deferred = instance._deferred - {self._name}
+        if not instance._initializing or not instance.id:
+            instance._dirty_mask |= self._bit
 
     def __set_name__(self, owner, name):
         # called on class definition time.
@@ -438,18 +1158,27 @@ class Field:
         self.desc = f"{name} DESC"
         self.asc = f"{name} ASC"
         self._owner = owner
-        if name == "id":
-            self._sql_type = "serial primary key"
-        elif self._type is int:
-            self._sql_type = "int"
+        # decide once what kind of values this field holds and how to convert
+        # them, instead of checking the type for every value converted from/to SQL
+        self._from_sql = self._to_sql = None  # as they are
+        if self._type is int:
+            self._kind = _KIND_INT
         elif self._type is str:
-            self._sql_type = f"varchar({self._options.get('max_length', 255)})"
+            self._kind = _KIND_STR
         elif issubclass(self._type, Model):
-            self._sql_type = "int"
+            self._kind = _KIND_MODEL
+            self._from_sql, self._to_sql = self._reference, self._model_id
         elif issubclass(self._type, Enum):
-            self._sql_type = "int"
+            self._kind = _KIND_ENUM
+            self._from_sql, self._to_sql = self._type, _enum_value
         else:
             raise RuntimeError(f"Don't know how to adapt type {self._type} to SQL")
+        if name == "id":
+            self._sql_type = "serial primary key"
+        elif self._kind is _KIND_STR:
+            self._sql_type = f"varchar({self._options.get('max_length', 255)})"
+        else:
+            self._sql_type = "int"
 
     def __eq__(self, other):
         return Expression("=", [self, other])
@@ -469,6 +1198,9 @@ class Field:
     def __ge__(self, other):
         return Expression(">=", [self, other])
 
+    def in_(self, values):
+        return Expression("IN", [self, tuple(values)])
+
     def __rand__(self, other):
         raise RuntimeError("You have to parenthesize your boolean expressions")
 
@@ -476,9 +1208,12 @@ class Field:
         raise RuntimeError("You have to parenthesize your boolean expressions")
 
     def __getattr__(self, attr):
-        if not issubclass(self._type, Model):
+        if self._kind is not _KIND_MODEL:
             raise AttributeError(f"As {self._type.__name__} is not a Model, we can't access the attribute {attr}")
-        return Expression(
+        # expressions are never modified, so the same join path can be reused
+        if attr in self._joins:
+            return self._joins[attr]
+        self._joins[attr] = Expression(
             "join",
             [
                 [
@@ -492,18 +1227,26 @@ class Field:
                 getattr(self._type, attr),
             ],
         )
+        return self._joins[attr]
 
 
 class Expression:
+    __slots__ = ("operator", "operands", "_joins")
+
     def __init__(self, operator, operands, join=None):
         self.operator = operator
         self.operands = operands
+        self._joins = None  # see __getattr__
 
     def __getattr__(self, attr):
-        if not issubclass(self.operands[-1]._type, Model) or self.operator != "join":
-            raise AttributeError(f"As {self._type.__name__} is not a Model, we can't access the attribute {attr}")
+        if self.operator != "join" or self.operands[-1]._kind is not _KIND_MODEL:
+            raise AttributeError(f"Can't access the attribute {attr} of {self!r}")
+        if self._joins is None:
+            self._joins = {}
+        elif attr in self._joins:
+            return self._joins[attr]
         field = self.operands[-1]
-        return Expression(
+        self._joins[attr] = Expression(
             "join",
             [
                 [
@@ -518,15 +1261,24 @@ class Expression:
                 getattr(field._type, attr),
             ],
         )
+        return self._joins[attr]
 
     def __repr__(self):
         return f"<{self.operator}{self.operands}>"
 
     def __and__(self, other):
-        return Expression("AND", [self, other])
+        return self._chain("AND", other)
 
     def __or__(self, other):
-        return Expression("OR", [self, other])
+        return self._chain("OR", other)
+
+    def _chain(self, operator, other):
+        # a & b & c becomes one AND with three operands instead of a nested tree
+        operands = [
+            *(self.operands if self.operator == operator else [self]),
+            *(other.operands if isinstance(other, Expression) and other.operator == operator else [other]),
+        ]
+        return Expression(operator, operands)
 
     def __eq__(self, other):
         return Expression("=", [self, other])
@@ -546,42 +1298,62 @@ class Expression:
     def __ge__(self, other):
         return Expression(">=", [self, other])
 
+    def in_(self, values):
+        return Expression("IN", [self, tuple(values)])
+
     def to_sql(self):
+        # iterative post-order walk: operands are visited left to right (so
+        # literals end up in placeholder order), and once all of them are on
+        # `out`, the (True, node) entry combines them
         literals = []
-        operands = []
         joins = []
-        if self.operator == "join":
-            if isinstance(self.operands[-1], Expression):
-                sql_operand, inner_literals, inner_joins = self.operands[-1].to_sql()
-                joins.extend(self.operands[0])
-                joins.extend(inner_joins)
-                literals.extend(inner_literals)
-            else:
-                joins.extend(self.operands[0])
-                sql_operand = self.operands[-1].to_sql()
-            operands.append(sql_operand)
-        else:
-            for operand in self.operands:
-                if hasattr(operand, "to_sql"):
-                    if isinstance(operand, Expression):
-                        sql_operand, inner_literals, inner_joins = operand.to_sql()
-                        operands.append(sql_operand)
-                        literals.extend(inner_literals)
-                        joins.extend(inner_joins)
-                    else:  # Field
-                        operands.append(operand.to_sql())
-                else:  # literal(ish) value
-                    if isinstance(operand, Enum):
-                        operand = operand.value
-                    elif isinstance(operand, Model):
-                        operand = operand.id
-                    literals.append(operand)
-                    operands.append("%s")
-        if self.operator == "join":
-            return operands[0], literals, joins
-        elif len(self.operands) == 1:
-            return f"{self.operator} {operands[0]}", literals, joins
-        elif len(self.operands) == 2:
-            return f"{operands[0]} {self.operator} {operands[1]}", literals, joins
+        out = []
+        stack = [(False, self)]
+        while stack:
+            combine, node = stack.pop()
+            if combine:
+                if node.operator == "join":
+                    continue  # its single operand's SQL is already on `out`
+                count = len(node.operands)
+                operands = out[-count:]
+                del out[-count:]
+                out.append(node._combine(operands))
+            elif isinstance(node, Expression):
+                if node.operator == "join":
+                    joins.extend(node.operands[0])
+                    children = node.operands[-1:]
+                else:
+                    children = node.operands
+                stack.append((True, node))
+                stack.extend((False, child) for child in reversed(children))
+            elif isinstance(node, Field):
+                out.append(node.to_sql())
+            else:  # literal(ish) value
+                if isinstance(node, Enum):
+                    node = node.value
+                elif isinstance(node, Model):
+                    node = node.id
+                elif isinstance(node, tuple):  # IN
+                    node = tuple(
+                        o.value if isinstance(o, Enum) else o.id if isinstance(o, Model) else o
+                        for o in node
+                    )
+                literals.append(node)
+                out.append("%s")
+        return out[0], literals, joins
+
+    def _combine(self, operands):
+        # parenthesize nested boolean expressions so that e.g. (a | b) & c
+        # doesn't turn into "a OR b AND c"
+        operands = [
+            f"({sql})" if isinstance(operand, Expression) and operand.operator in ("AND", "OR") else sql
+            for operand, sql in zip(self.operands, operands)
+        ]
+        if len(operands) == 1:
+            return f"{self.operator} {operands[0]}"
+        elif self.operator in ("AND", "OR"):
+            return f" {self.operator} ".join(operands)
+        elif len(operands) == 2:
+            return f"{operands[0]} {self.operator} {operands[1]}"
         else:
             raise RuntimeError("Fuckup in Expression: can't have more than 2 operands")